@@ -0,0 +1,172 @@
+# -*- coding: utf-8 -*-
+"""Telegram command and document handlers."""
+
+import asyncio
+import io
+import json
+import logging
+import sqlite3
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from telegram import Update
+from telegram.ext import ContextTypes
+
+from pdf_parse import parse_pdf
+from sheets import get_google_service, sync_patient_sheet
+
+# ---------------- CONFIG ----------------
+USER_SHEETS_DB = "user_sheets.db"
+# Mapping file of earlier versions, imported into USER_SHEETS_DB on first use
+USER_SHEETS_FILE = "user_sheets.json"
+# Bot API refuses getFile for documents larger than this
+MAX_PDF_SIZE = 20 * 1024 * 1024
+
+# -------------- User sheet mapping --------------
+# One shared connection; sqlite3 connections must not be used by two threads at once
+_DB_LOCK = threading.Lock()
+_DB_CONN = None
+
+
+def _user_sheets_db():
+    """Opens USER_SHEETS_DB on first use. Caller holds _DB_LOCK."""
+    global _DB_CONN
+    if _DB_CONN is None:
+        conn = sqlite3.connect(USER_SHEETS_DB, check_same_thread=False)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("CREATE TABLE IF NOT EXISTS sheets(user_id INTEGER PRIMARY KEY, sheet_id TEXT)")
+        _import_user_sheets_json(conn)
+        _DB_CONN = conn
+    return _DB_CONN
+
+
+def _import_user_sheets_json(conn):
+    if conn.execute("SELECT 1 FROM sheets LIMIT 1").fetchone():
+        return
+    try:
+        with open(USER_SHEETS_FILE, "r", encoding="utf-8") as f:
+            data = json.load(f)
+    except FileNotFoundError:
+        return
+    except Exception as e:
+        logging.warning("Could not import %s: %s", USER_SHEETS_FILE, e)
+        return
+    with conn:
+        conn.executemany(
+            "INSERT OR REPLACE INTO sheets(user_id, sheet_id) VALUES (?, ?)",
+            [(int(user_id), sheet_id) for user_id, sheet_id in data.items()],
+        )
+
+
+def get_user_sheet_id(user_id: int):
+    with _DB_LOCK:
+        row = _user_sheets_db().execute("SELECT sheet_id FROM sheets WHERE user_id = ?", (user_id,)).fetchone()
+    return row[0] if row else None
+
+
+def set_user_sheet_id(user_id: int, sheet_id: str):
+    with _DB_LOCK:
+        conn = _user_sheets_db()
+        with conn:
+            conn.execute("INSERT OR REPLACE INTO sheets(user_id, sheet_id) VALUES (?, ?)", (user_id, sheet_id))
+
+
+# -------------- Telegram handlers --------------
+# Blocking work (PDF parsing, user sheet mapping lookups and upserts) runs here so
+# the event loop keeps serving other users meanwhile (updates are handled
+# concurrently, see main.py)
+HANDLER_CONCURRENCY = 8
+_HANDLER_POOL = ThreadPoolExecutor(max_workers=HANDLER_CONCURRENCY)
+# At most this many uploads talk to Google Sheets at the same time
+SHEETS_CONCURRENCY = 5
+_SHEETS_SEM = asyncio.Semaphore(SHEETS_CONCURRENCY)
+# Google API calls get their own small pool: each of its threads keeps one
+# authorized keep-alive connection, so connections are reused across uploads
+_SHEETS_POOL = ThreadPoolExecutor(max_workers=SHEETS_CONCURRENCY)
+
+
+async def run_blocking(func, *args, pool=_HANDLER_POOL):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(pool, func, *args)
+
+
+async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    await update.message.reply_text(
+        "👋 Привет! Отправь PDF с анализами. \n"
+        "Перед использованием укажи таблицу: /set_sheet <SPREADSHEET_ID> \n"
+        "Пример SPREADSHEET_ID: это длинная строка в URL после /d/"
+    )
+
+
+async def set_sheet(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user_id = update.effective_user.id
+    if not context.args or len(context.args) < 1:
+        await update.message.reply_text("Использование: /set_sheet <SPREADSHEET_ID>")
+        return
+    sheet_id = context.args[0].strip()
+    await run_blocking(set_user_sheet_id, user_id, sheet_id)
+    await update.message.reply_text(f"✔ Таблица сохранена: {sheet_id}")
+
+
+async def handle_pdf(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user_id = update.effective_user.id
+    sheet_id = await run_blocking(get_user_sheet_id, user_id)
+    if not sheet_id:
+        await update.message.reply_text("Вы не указали Google Sheet. Сделайте: /set_sheet <ID>")
+        return
+
+    doc = update.message.document
+    if not doc:
+        await update.message.reply_text("Пожалуйста, отправьте PDF-файл (document).")
+        return
+    if not doc.file_name.lower().endswith(".pdf"):
+        await update.message.reply_text("Пожалуйста, отправьте файл в формате PDF.")
+        return
+    if doc.file_size and doc.file_size > MAX_PDF_SIZE:
+        await update.message.reply_text("Файл слишком большой: Telegram позволяет ботам скачивать до 20 МБ.")
+        return
+
+    await update.message.reply_text("📥 Скачиваю файл...")
+    file = await doc.get_file()
+    bio = io.BytesIO()
+    await file.download_to_memory(out=bio)
+    # bytes, not bytearray: getvalue() hands over the buffer and fitz opens bytes
+    # without copying them again
+    pdf_bytes = bio.getvalue()
+
+    await update.message.reply_text("🔎 Парсю PDF...")
+    try:
+        full_name, date_str, analytes = await run_blocking(parse_pdf, pdf_bytes)
+    except Exception as e:
+        logging.exception("Парсер упал: %s", e)
+        await update.message.reply_text("Ошибка при разборе PDF.")
+        return
+
+    await update.message.reply_text(f"Пациент: {full_name}\nДата: {date_str}\nПоказателей: {len(analytes)}")
+    if not analytes:
+        # Typically a scan without a text layer; nothing worth a Sheets round-trip
+        await update.message.reply_text("Не удалось найти показатели в PDF (возможно, это скан без текста).")
+        return
+
+    # Cap concurrent Sheets work so bursts of uploads stay within the API quota
+    async with _SHEETS_SEM:
+        await write_to_sheet(update, sheet_id, full_name, date_str, analytes)
+
+
+async def write_to_sheet(update: Update, sheet_id, full_name, date_str, analytes):
+    # Get Google service (interactive if needed)
+    service = await run_blocking(get_google_service, True, pool=_SHEETS_POOL)
+    if not service:
+        await update.message.reply_text("Ошибка авторизации Google.")
+        return
+
+    # One read and one write for the whole upload
+    values = {name: value for name, (value, _ref) in analytes.items()}
+    try:
+        await run_blocking(sync_patient_sheet, service, sheet_id, full_name, date_str, values, pool=_SHEETS_POOL)
+    except Exception as e:
+        logging.exception("Ошибка при записи в Google Sheets: %s", e)
+        await update.message.reply_text("Ошибка при записи значений в таблицу.")
+        return
+
+    await update.message.reply_text("✅ Данные записаны в Google Sheet.")
@@ -0,0 +1,265 @@
+# -*- coding: utf-8 -*-
+"""Heuristic extraction of patient name, sample date and analytes from lab PDFs."""
+
+import logging
+import fitz
+import multiprocessing
+import os
+import re
+import sys
+import tempfile
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from datetime import datetime
+from itertools import repeat
+
+try:
+    import ahocorasick
+except ImportError:  # optional speedup, a single alternation regex is used instead
+    ahocorasick = None
+
+try:
+    import re2
+except ImportError:  # optional, Python's backtracking re is used instead
+    re2 = None
+
+# -------------- PDF parsing (heuristic) --------------
+# Case-insensitivity is scoped to the literal labels; name characters use explicit classes
+_RE_FIO_SURNAME = re.compile(r"(?i:Фамилия)[:\s]*([А-ЯЁа-яё][А-ЯЁа-яё\-]+)")
+# Rest of the surname line, then first and middle name on the next line
+_RE_FIO_NAMES = re.compile(r"[^\n]*\n.*?([\wЁёА-Яа-я]+\s+[\wЁёА-Яа-я]+)")
+_RE_FIO_FULL = re.compile(r"ФИО[:\s]+([\wЁёА-Яа-я]+\s+[\wЁёА-Яа-я]+\s+[\wЁёА-Яа-я]+)")
+# Line break with the whitespace around it, including any blank lines. Breaks are
+# everything str.splitlines() splits on (\r, \f, \v, \x85, U+2028... besides \n)
+_RE_LINE_BREAK = re.compile(r"[^\S\n]*[\n\r\x0b\x0c\x1c-\x1e\x85\u2028\u2029]\s*")
+_RE_CAPITALIZED_WORD = re.compile(r"[А-ЯЁ][а-яё]+")
+_RE_DATE_SAMPLE = re.compile(r"Дата взятия образца[:\s]*([0-3]?\d[.\-/][01]?\d[.\-/]\d{4})")
+_RE_DATE_ANY = re.compile(r"(\d{2}[.\-/]\d{2}[.\-/]\d{4})")
+# Horizontal whitespace, including the no-break space PyMuPDF keeps in lab tables.
+# Spelled out literally: RE2's \s is ASCII-only and it has no \u escape
+_HSPACE = " \t\u00a0"
+# Loosen matching: name then number then possible units then ref.
+# One line per match: only _HSPACE between fields and a bounded name keep the scan linear.
+# The pattern sticks to syntax RE2 understands (inline flags, no backreferences) so the
+# whole-document scan can run on RE2's automaton when google-re2 is installed
+_RE_ANALYTE_LINE = (re2 or re).compile(
+    r"(?m)^([А-ЯЁа-яёA-Za-z0-9" + _HSPACE + r"\-\(\)\/%µμΜ]{1,60}?)[" + _HSPACE + r"]+([<>]?\d+[.,]?\d*)"
+    r"[" + _HSPACE + r"]*(?:[^\d\n]{0,8})[" + _HSPACE + r"]*"
+    r"([\d.,<>]+–[\d.,<>]+|<\d+|>?\d+|(?i:отрицательно|не обнаружено))?"
+)
+_RE_ANALYTE_TOKEN = re.compile(r"([А-ЯЁа-яA-Za-z\-\s]{3,60}?)[:\s]{1,3}([0-9]+(?:[.,][0-9]+)?)\s*([^\d\n]*)")
+# Value following a known analyte name on the same line
+_RE_VALUE_AFTER_NAME = re.compile(r"[^\d\n]{0,20}?([<>]?\d+(?:[.,]\d+)?)")
+
+# Analyte names searched for when the line-based pattern finds nothing
+KNOWN_ANALYTES = frozenset([
+    "Гемоглобин", "Гематокрит", "Эритроциты", "Лейкоциты", "Тромбоциты", "СОЭ",
+    "Нейтрофилы", "Лимфоциты", "Моноциты", "Эозинофилы", "Базофилы",
+    "Глюкоза", "Гликированный гемоглобин", "Холестерин общий", "Холестерин ЛПНП",
+    "Холестерин ЛПВП", "Триглицериды", "Креатинин", "Мочевина", "Мочевая кислота",
+    "Билирубин общий", "Билирубин прямой", "АЛТ", "АСТ", "ГГТ", "Щелочная фосфатаза",
+    "Общий белок", "Альбумин", "С-реактивный белок", "Ферритин", "Железо",
+    "Калий", "Натрий", "Кальций", "Магний", "ТТГ", "Т4 свободный", "Т3 свободный",
+    "Витамин D", "Витамин B12", "Фолиевая кислота",
+])
+_KNOWN_ANALYTES_BY_KEY = {name.lower(): name for name in KNOWN_ANALYTES}
+
+if ahocorasick is not None:
+    _KNOWN_ANALYTES_AC = ahocorasick.Automaton()
+    for _key in _KNOWN_ANALYTES_BY_KEY:
+        _KNOWN_ANALYTES_AC.add_word(_key, _key)
+    _KNOWN_ANALYTES_AC.make_automaton()
+else:
+    _RE_KNOWN_ANALYTES = re.compile(
+        "|".join(re.escape(k) for k in sorted(_KNOWN_ANALYTES_BY_KEY, key=len, reverse=True))
+    )
+
+
+def _known_analyte_spans(lowered):
+    if ahocorasick is None:
+        return [m.span() for m in _RE_KNOWN_ANALYTES.finditer(lowered)]
+    return [(end - len(key) + 1, end + 1) for end, key in _KNOWN_ANALYTES_AC.iter(lowered)]
+
+
+def find_known_analytes(text):
+    """Find KNOWN_ANALYTES in text in a single pass, with the value that follows each."""
+    lowered = text.lower()
+    analytes = {}
+    last_end = -1
+    # Longest name first at each position, so "Гликированный гемоглобин" wins over "гемоглобин"
+    for start, end in sorted(_known_analyte_spans(lowered), key=lambda span: (span[0], -span[1])):
+        if start < last_end:
+            continue
+        # Whole words only
+        if (start > 0 and lowered[start - 1].isalnum()) or (end < len(lowered) and lowered[end].isalnum()):
+            continue
+        m = _RE_VALUE_AFTER_NAME.match(lowered, end)
+        if not m:
+            continue
+        last_end = end
+        name = _KNOWN_ANALYTES_BY_KEY[lowered[start:end]]
+        analytes.setdefault(name, (m.group(1).replace(",", "."), ""))
+    return analytes
+
+
+def open_pdf(source):
+    """Open a PDF given either its raw bytes or a filesystem path."""
+    if isinstance(source, (bytes, bytearray)):
+        return fitz.open(stream=source, filetype="pdf")
+    return fitz.open(source)
+
+
+# PyMuPDF holds the GIL and is not thread-safe, so pages of longer reports
+# are extracted in worker processes, each opening its own copy of the document.
+# Within this process only one handler thread at a time may use fitz
+_FITZ_LOCK = threading.Lock()
+_PDF_WORKERS = 4
+
+
+def _new_pdf_pool():
+    # Workers start lazily from a handler thread; forking a process that runs threads
+    # can deadlock the child, so they come from a forkserver (spawn where unavailable)
+    if "forkserver" in multiprocessing.get_all_start_methods():
+        context = multiprocessing.get_context("forkserver")
+        # The server imports this module and fitz once instead of every worker
+        context.set_forkserver_preload([__name__])
+    else:
+        context = multiprocessing.get_context("spawn")
+    return ProcessPoolExecutor(max_workers=_PDF_WORKERS, mp_context=context)
+
+
+_PDF_POOL = _new_pdf_pool()
+# Held while swapping out a broken _PDF_POOL
+_PDF_POOL_LOCK = threading.Lock()
+# Below this the temp file and per-worker document open cost more than they save
+_PARALLEL_MIN_PAGES = 8
+
+
+def page_text(page):
+    # Pages without fonts (scans, logos, blank separators) have no text layer
+    if not page.get_fonts():
+        return ""
+    return page.get_text("text")
+
+
+def _pages_text(path, start, stop):
+    doc = open_pdf(path)
+    try:
+        return [page_text(doc[i]) for i in range(start, stop)]
+    finally:
+        doc.close()
+
+
+def _replace_pdf_pool(broken):
+    global _PDF_POOL
+    with _PDF_POOL_LOCK:
+        if _PDF_POOL is broken:
+            _PDF_POOL = _new_pdf_pool()
+    broken.shutdown(wait=False)
+
+
+def _extract_in_pool(path, page_count):
+    # One contiguous slice per worker, so each opens the document only once
+    step = -(-page_count // _PDF_WORKERS)
+    starts = range(0, page_count, step)
+    stops = [min(start + step, page_count) for start in starts]
+    # A worker killed by MuPDF breaks the whole pool, possibly while serving another
+    # upload: start a new pool and retry once; a second break fails this document
+    for retry in (True, False):
+        pool = _PDF_POOL
+        try:
+            slices = list(pool.map(_pages_text, repeat(path, len(starts)), starts, stops))
+            break
+        except BrokenProcessPool:
+            _replace_pdf_pool(pool)
+            if not retry:
+                raise
+            logging.warning("PDF worker pool broke, retrying in a new one")
+    return [text for chunk in slices for text in chunk]
+
+
+def extract_page_texts(source):
+    """Return the text of every page, in page order."""
+    with _FITZ_LOCK:
+        doc = open_pdf(source)
+        try:
+            page_count = doc.page_count
+            if page_count < _PARALLEL_MIN_PAGES:
+                return [page_text(page) for page in doc]
+        finally:
+            doc.close()
+    if not isinstance(source, (bytes, bytearray)):
+        return _extract_in_pool(source, page_count)
+    # Written to disk once, so workers get a path instead of a pickled copy each
+    with tempfile.NamedTemporaryFile(suffix=".pdf", delete=False) as tmp:
+        tmp.write(source)
+    try:
+        return _extract_in_pool(tmp.name, page_count)
+    finally:
+        os.unlink(tmp.name)
+
+
+def parse_pdf(source):
+    """Return (full_name, date_str, analytes_dict)
+    source: PDF contents as bytes, or a path to the file.
+    analytes_dict: { 'Гемоглобин': ('155', '135–169'), ... }
+    """
+    try:
+        text_parts = extract_page_texts(source)
+    except Exception as e:
+        logging.error("PyMuPDF failed: %s", e)
+        # fallback: try reading file bytes and attempt OCR? (not implemented here)
+        raise
+
+    # Normalize: strip every line and drop blank ones (and blank pages) in one regex pass
+    joined_text = _RE_LINE_BREAK.sub("\n", "\n".join(p for p in text_parts if p)).strip()
+
+    # FIO detection: try several patterns
+    fio = None
+    m = _RE_FIO_SURNAME.search(joined_text)
+    if m:
+        surname = m.group(1).strip()
+        # try to find full name nearby
+        m2 = _RE_FIO_NAMES.match(joined_text, m.end())
+        fio = (surname + " " + m2.group(1).strip()) if m2 else surname
+    if not fio:
+        # fallback to pattern "ФИО: Иванов Иван Иванович"
+        m = _RE_FIO_FULL.search(joined_text)
+        if m:
+            fio = m.group(1).strip()
+    if not fio:
+        # take first line with 2-3 cyrillic words
+        for ln in joined_text.split("\n", 12)[:12]:
+            parts = _RE_CAPITALIZED_WORD.findall(ln)
+            if len(parts) >= 2:
+                fio = ln.strip()
+                break
+    full_name = fio if fio else "Пациент"
+
+    # Date detection (prefer sample date)
+    date_match = _RE_DATE_SAMPLE.search(joined_text)
+    if not date_match:
+        date_match = _RE_DATE_ANY.search(joined_text)
+    date_str = date_match.group(1) if date_match else datetime.now().strftime("%d.%m.%Y")
+
+    # Extract analytes: lines that contain a name, a numeric value and a reference or range
+    analytes = {}
+    for m in _RE_ANALYTE_LINE.finditer(joined_text):
+        name, val, ref = m.group(1, 2, 3)
+        # interned: the same few dozen names recur across every report.
+        # The value and reference groups cannot carry surrounding whitespace.
+        analytes[sys.intern(name.strip())] = (val.replace(",", "."), ref.replace(" ", "") if ref else "")
+
+    # If analytes empty, look for known analyte names anywhere in the text
+    if not analytes:
+        analytes = find_known_analytes(joined_text)
+
+    # Still empty: try to find "Name ... value ... range" inside text by tokens
+    if not analytes:
+        tokens = _RE_ANALYTE_TOKEN.findall(joined_text)
+        for t in tokens:
+            name = sys.intern(t[0].strip())
+            analytes[name] = (t[1].replace(",", "."), "")
+
+    return full_name, date_str, analytes
@@ -0,0 +1,418 @@
+# -*- coding: utf-8 -*-
+"""Google OAuth and Google Sheets helpers."""
+
+import os
+import logging
+import math
+import threading
+import time
+
+import httplib2
+from google.oauth2.credentials import Credentials
+from google_auth_httplib2 import AuthorizedHttp
+from google_auth_oauthlib.flow import InstalledAppFlow
+from googleapiclient.discovery import build
+from googleapiclient.errors import HttpError
+from googleapiclient.http import HttpRequest
+from google.auth.transport.requests import Request
+
+# ---------------- CONFIG ----------------
+SCOPES = ["https://www.googleapis.com/auth/spreadsheets"]
+TOKEN_FILE = "token.json"
+# Retries (with exponential backoff) of Sheets requests failing with 429 / 5xx
+SHEETS_RETRIES = 5
+# Socket timeout (seconds) of Google API connections
+HTTP_TIMEOUT = 20
+# Seconds a patient sheet's cached column A is trusted before re-reading it,
+# so rows inserted or removed by hand in the UI are picked up eventually
+ANALYTE_INDEX_TTL = 300
+# Seconds the list of sheets in a spreadsheet is reused before asking again
+SHEET_IDS_TTL = 300
+
+# Built Sheets service and its credentials, reused by every handler once authorized
+_SERVICE_CACHE = {"service": None, "creds": None}
+# Held while loading/refreshing the token so concurrent handlers share one refresh
+_SERVICE_LOCK = threading.Lock()
+# Per-thread authorized connection, see _thread_http
+_HTTP_LOCAL = threading.local()
+# Column A per (spreadsheet_id, sheet_name) as (loaded_at, values), see fetch_sheet_state
+_ANALYTE_INDEX = {}
+# Sheet ids by title per spreadsheet_id as (loaded_at, {title: sheetId})
+_SHEET_IDS_CACHE = {}
+# One lock per spreadsheet_id: the caches above and the sheet ids and rows
+# picked from them hold only while no other upload writes to the spreadsheet
+_SPREADSHEET_LOCKS = {}
+_SPREADSHEET_LOCKS_GUARD = threading.Lock()
+
+# -------------- Google OAuth / Service --------------
+def get_google_service(interactive=True):
+    """
+    Returns Google Sheets service object.
+    If token.json is missing or expired, starts InstalledAppFlow (interactive).
+    interactive=False will not prompt for code and will return None if no token.
+    The service is built once per process; afterwards only an expired access
+    token is refreshed (and saved), never a full re-authorization.
+    """
+    cache = _SERVICE_CACHE
+    if cache["service"] is not None and cache["creds"].valid:
+        return cache["service"]
+    with _SERVICE_LOCK:
+        # Another handler may have finished the refresh while we were waiting
+        if cache["service"] is None:
+            creds = _load_credentials(interactive)
+            if creds is None:
+                return None
+            cache["service"] = _build_service(creds)
+            cache["creds"] = creds
+        elif not cache["creds"].valid:
+            _refresh_credentials(cache["creds"])
+        return cache["service"]
+
+
+def _refresh_credentials(creds):
+    try:
+        creds.refresh(Request())
+    except Exception as e:
+        logging.warning("Failed to refresh token: %s", e)
+        return
+    _save_token(creds)
+
+
+def _save_token(creds):
+    try:
+        with open(TOKEN_FILE, "w", encoding="utf-8") as token_out:
+            token_out.write(creds.to_json())
+    except Exception as e:
+        logging.warning("Could not save token file: %s", e)
+
+
+def _load_credentials(interactive):
+    try:
+        creds = Credentials.from_authorized_user_file(TOKEN_FILE, SCOPES)
+    except FileNotFoundError:
+        creds = None
+    except Exception as e:
+        logging.warning("Failed loading token file: %s", e)
+        creds = None
+
+    if not creds or not creds.valid:
+        if creds and creds.expired and creds.refresh_token:
+            _refresh_credentials(creds)
+            return creds
+        else:
+            if not interactive:
+                logging.error("No valid credentials and interactive=False")
+                return None
+            # Need user consent
+            client_id = os.environ.get("GOOGLE_CLIENT_ID")
+            client_secret = os.environ.get("GOOGLE_CLIENT_SECRET")
+            if not client_id or not client_secret:
+                logging.error("GOOGLE_CLIENT_ID / GOOGLE_CLIENT_SECRET not set in env")
+                return None
+
+            flow = InstalledAppFlow.from_client_config(
+                {
+                    "installed": {
+                        "client_id": client_id,
+                        "client_secret": client_secret,
+                        "redirect_uris": ["urn:ietf:wg:oauth:2.0:oob"],
+                        "auth_uri": "https://accounts.google.com/o/oauth2/auth",
+                        "token_uri": "https://oauth2.googleapis.com/token",
+                    }
+                },
+                SCOPES,
+            )
+
+            # offline access makes Google issue a refresh_token, kept in token.json
+            auth_url, _ = flow.authorization_url(access_type="offline", prompt="consent")
+            # Show URL in stdout/logs
+            print("\n--- GOOGLE AUTH REQUIRED ---\n")
+            print("Open this URL in a browser and authorize the app:\n")
+            print(auth_url)
+            print("\nAfter allowing access, copy the authorization code and paste it here.\n")
+            code = input("Authorization code: ").strip()
+            flow.fetch_token(code=code)
+            creds = flow.credentials
+            _save_token(creds)
+
+    return creds
+
+
+def _build_service(creds):
+    # Every request goes through the calling thread's own connection
+    def request_builder(http, *args, **kwargs):
+        return HttpRequest(_thread_http(creds), *args, **kwargs)
+
+    try:
+        return build(
+            "sheets",
+            "v4",
+            http=_thread_http(creds),
+            requestBuilder=request_builder,
+            cache_discovery=False,
+        )
+    except HttpError as e:
+        logging.error("Google API error: %s", e)
+        return None
+
+
+def _thread_http(creds):
+    """
+    httplib2.Http is not thread-safe, so each handler thread gets its own
+    AuthorizedHttp. It lives as long as the thread, which keeps the TLS
+    connection to Google alive between uploads.
+    """
+    cached = getattr(_HTTP_LOCAL, "authorized", None)
+    if cached is None or cached[0] is not creds:
+        cached = _HTTP_LOCAL.authorized = (creds, AuthorizedHttp(creds, http=httplib2.Http(timeout=HTTP_TIMEOUT)))
+    return cached[1]
+
+
+# -------------- Google Sheets helpers --------------
+def get_sheet_ids(service, spreadsheet_id, fresh=False):
+    """
+    Returns {title: sheetId}, served from _SHEET_IDS_CACHE for SHEET_IDS_TTL
+    seconds unless fresh is set.
+    """
+    cached = _SHEET_IDS_CACHE.get(spreadsheet_id)
+    if not fresh and cached and time.monotonic() - cached[0] < SHEET_IDS_TTL:
+        return dict(cached[1])
+    meta = (
+        service.spreadsheets()
+        .get(spreadsheetId=spreadsheet_id, fields="sheets.properties(sheetId,title)")
+        .execute(num_retries=SHEETS_RETRIES)
+    )
+    sheets = {s["properties"]["title"]: s["properties"]["sheetId"] for s in meta.get("sheets", [])}
+    _SHEET_IDS_CACHE[spreadsheet_id] = (time.monotonic(), sheets)
+    return dict(sheets)
+
+
+def fetch_sheet_state(service, spreadsheet_id, sheet_name):
+    """
+    Reads everything needed about the spreadsheet in two requests:
+    sheet ids by title, column A and the header row of sheet_name.
+    Returns (sheets, col_a, header_row, col_a_loaded_at); col_a and
+    header_row are empty if the patient sheet does not exist yet. The
+    helpers below keep this state up to date, so the sheet never has to
+    be re-read.
+    Column A comes from _ANALYTE_INDEX when fresh; then only the header
+    row is fetched. col_a_loaded_at is when column A was last actually
+    read, so writing through the cache does not extend its lifetime.
+    """
+    started = time.monotonic()
+    sheets = get_sheet_ids(service, spreadsheet_id)
+    if sheet_name not in sheets and _SHEET_IDS_CACHE[spreadsheet_id][0] < started:
+        # About to add a sheet: its id must not clash with sheets added since caching
+        sheets = get_sheet_ids(service, spreadsheet_id, fresh=True)
+    key = (spreadsheet_id, sheet_name)
+    if sheet_name not in sheets:
+        _ANALYTE_INDEX.pop(key, None)
+        return sheets, [], [], time.monotonic()
+
+    cached = _ANALYTE_INDEX.get(key)
+    if cached and time.monotonic() - cached[0] < ANALYTE_INDEX_TTL:
+        # Copy: a failed write must not leave its new rows in the cached list
+        col_a = list(cached[1])
+        loaded_at = cached[0]
+        ranges = [f"{sheet_name}!1:1"]
+    else:
+        col_a = None
+        loaded_at = time.monotonic()
+        ranges = [f"{sheet_name}!A:A", f"{sheet_name}!1:1"]
+
+    # Column-major: A:A comes back as a single list, 1:1 as one list per column
+    res = service.spreadsheets().values().batchGet(
+        spreadsheetId=spreadsheet_id,
+        ranges=ranges,
+        majorDimension="COLUMNS",
+    ).execute(num_retries=SHEETS_RETRIES)
+    value_ranges = res.get("valueRanges", [])
+    header_range = value_ranges[-1] if value_ranges else {}
+    if col_a is None:
+        col_a = ((value_ranges[0] if value_ranges else {}).get("values") or [[]])[0]
+    header_row = [c[0] if c else "" for c in header_range.get("values", [])]
+    return sheets, col_a, header_row, loaded_at
+
+
+def text_cell(value):
+    return {"userEnteredValue": {"stringValue": str(value)}}
+
+
+def cell_data(value):
+    # Analyte values that are numbers are stored as numbers; everything else
+    # ("<5", "отрицательно") stays plain text. NaN/Infinity are not valid JSON
+    try:
+        number = float(value)
+    except (TypeError, ValueError):
+        return text_cell(value)
+    if not math.isfinite(number):
+        return text_cell(value)
+    return {"userEnteredValue": {"numberValue": number}}
+
+
+def update_cells(sheet_id, row_index, column_index, rows, cell=text_cell):
+    """
+    updateCells request writing rows (lists of values) from the 0-based cell
+    (row_index, column_index). Values are written as text unless another
+    cell builder is given, e.g. cell_data for analyte values.
+    """
+    return {
+        "updateCells": {
+            "start": {"sheetId": sheet_id, "rowIndex": row_index, "columnIndex": column_index},
+            "rows": [{"values": [cell(v) for v in row]} for row in rows],
+            "fields": "userEnteredValue",
+        }
+    }
+
+
+def create_patient_sheet(spreadsheet_id, sheet_name, sheets, col_a, header_row):
+    """
+    Returns requests adding sheet_name with its header row
+    (A1="Показатель", B1="Референс"), sent with the rest of the batch.
+    """
+    # Pick the id ourselves so later requests of the same batch can refer to it
+    sheet_id = max(sheets.values(), default=0) + 1
+    sheets[sheet_name] = sheet_id
+    cached = _SHEET_IDS_CACHE.get(spreadsheet_id)
+    if cached:
+        cached[1][sheet_name] = sheet_id
+    col_a[:] = ["Показатель"]
+    header_row[:] = ["Показатель", "Референс"]
+    return [
+        {
+            "addSheet": {
+                "properties": {
+                    "sheetId": sheet_id,
+                    "title": sheet_name,
+                    "gridProperties": {"rowCount": 2000, "columnCount": 50},
+                }
+            }
+        },
+        update_cells(sheet_id, 0, 0, [header_row[:]]),
+    ]
+
+
+def ensure_rows_for_analytes(sheet_id, analytes, col_a):
+    """
+    Returns (row_map, requests): row_map maps every lowercased analyte name
+    in column A, including the missing ones added by requests, to its row.
+    """
+    rows = analyte_rows(col_a)
+    missing = []
+    for a in analytes:
+        key = a.strip().lower()
+        if key not in rows:
+            missing.append(a)
+            rows[key] = len(col_a) + len(missing)
+    if not missing:
+        return rows, []
+    first_row = len(col_a) + 1
+    col_a.extend(missing)
+    return rows, [update_cells(sheet_id, first_row - 1, 0, [[m] for m in missing])]
+
+
+def get_next_date_column(sheet_id, date_str, header):
+    """
+    Returns (col, requests) with the 1-based column holding date_str,
+    adding it at the end of the header row when it is not there yet.
+    """
+    # header may be empty
+    if date_str in header:
+        return header.index(date_str) + 1, []
+    # append at the end
+    header.append(date_str)
+    col = len(header)
+    return col, [update_cells(sheet_id, 0, col - 1, [[date_str]])]
+
+
+def apply_requests(service, spreadsheet_id, requests):
+    if not requests:
+        return
+    service.spreadsheets().batchUpdate(
+        spreadsheetId=spreadsheet_id,
+        body={"requests": requests},
+    ).execute(num_retries=SHEETS_RETRIES)
+
+
+def analyte_rows(col_a):
+    """Map lowercased analyte name -> 1-based row number (first occurrence wins)."""
+    rows = {}
+    for i, name in enumerate(col_a, start=1):
+        rows.setdefault(name.strip().lower(), i)
+    return rows
+
+
+def write_values(sheet_id, col, row_map, values_dict):
+    """
+    Returns requests putting values_dict: {analyte_name: value} into the
+    1-based column col at the row_map rows. Consecutive rows share one
+    updateCells; rows without a value are left out, so their cells stay
+    untouched.
+    """
+    cells = {}
+    for analyte, value in values_dict.items():
+        row = row_map.get(analyte.strip().lower())
+        if row is None:
+            logging.warning("No row for %s on sheet %s", analyte, sheet_id)
+            continue
+        cells[row] = value
+    requests = []
+    run = []
+    for row in sorted(cells):
+        if run and row != run[-1] + 1:
+            requests.append(update_cells(sheet_id, run[0] - 1, col - 1, [[cells[r]] for r in run], cell_data))
+            run = []
+        run.append(row)
+    if run:
+        requests.append(update_cells(sheet_id, run[0] - 1, col - 1, [[cells[r]] for r in run], cell_data))
+    return requests
+
+
+def _spreadsheet_lock(spreadsheet_id):
+    with _SPREADSHEET_LOCKS_GUARD:
+        return _SPREADSHEET_LOCKS.setdefault(spreadsheet_id, threading.Lock())
+
+
+def sync_patient_sheet(service, spreadsheet_id, sheet_name, date_str, values_dict):
+    """
+    Writes values_dict: {analyte_name: value} under date_str on sheet_name,
+    creating the sheet, analyte rows and date column as needed.
+    Reads the sheet once up front (sheet list and column A usually from
+    cache), then sends everything (new sheet, date header, new analyte
+    names, values) as a single spreadsheets.batchUpdate.
+    Uploads to the same spreadsheet run one at a time.
+    A request rejected as invalid usually means the cached layout is stale
+    (sheet renamed, deleted or rearranged by hand); then the write is
+    tried once more on freshly read state.
+    """
+    with _spreadsheet_lock(spreadsheet_id):
+        try:
+            _sync_patient_sheet(service, spreadsheet_id, sheet_name, date_str, values_dict)
+        except HttpError as e:
+            if e.resp.status not in (400, 404):
+                raise
+            logging.warning("Sheets rejected the write to %s, retrying on fresh state: %s", sheet_name, e)
+            _sync_patient_sheet(service, spreadsheet_id, sheet_name, date_str, values_dict)
+
+
+def _sync_patient_sheet(service, spreadsheet_id, sheet_name, date_str, values_dict):
+    key = (spreadsheet_id, sheet_name)
+    try:
+        sheets, col_a, header_row, loaded_at = fetch_sheet_state(service, spreadsheet_id, sheet_name)
+        requests = []
+        if sheet_name not in sheets:
+            requests += create_patient_sheet(spreadsheet_id, sheet_name, sheets, col_a, header_row)
+        sheet_id = sheets[sheet_name]
+        row_map, row_requests = ensure_rows_for_analytes(sheet_id, values_dict, col_a)
+        requests += row_requests
+        col, date_requests = get_next_date_column(sheet_id, date_str, header_row)
+        requests += date_requests
+        requests += write_values(sheet_id, col, row_map, values_dict)
+        apply_requests(service, spreadsheet_id, requests)
+    except Exception:
+        # Cached layout may be stale and it is unknown how much of the write
+        # landed; read everything again next time
+        _SHEET_IDS_CACHE.pop(spreadsheet_id, None)
+        _ANALYTE_INDEX.pop(key, None)
+        raise
+    _ANALYTE_INDEX[key] = (loaded_at, col_a)